@@ -1,5 +1,178 @@
+import functools
+import hashlib
+import re
+from typing import NamedTuple
+
+import numpy as np
 import pandas as pd
 from pandas.api.types import is_numeric_dtype
+from xlsxwriter.utility import xl_rowcol_to_cell
+
+# background colours used for each named colour
+_PALETTE = {'red': '#FFC7CE', 'green': '#C6EFCE'}
+
+
+def _parse_colour(value: str) -> str:
+    """
+    Given the value of a C or c instruction, return the colour it names: 'red'
+    for 'r', the code itself for a hex colour code (e.g. '#FFEB9C'), and
+    'green' otherwise.
+    """
+    if value == 'r':
+        return 'red'
+    if value.startswith('#'):
+        return value
+    return 'green'
+
+
+# maps each instruction letter to the option it sets and the function used to
+# convert its value
+_INSTRUCTION_DISPATCH = {
+    'M': ('margin_upper', float),
+    'm': ('margin_lower', float),
+    'C': ('colour_upper', _parse_colour),
+    'c': ('colour_lower', _parse_colour),
+    'p': ('majority_percentage', float),
+    's': ('formatting_option', {'u': 'colour_upper', 'l': 'colour_lower',
+                                'b': 'colour_both'}.__getitem__),
+    'o': ('row_offset', int),
+    'O': ('column_offset', int),
+}
+
+
+class _ParsedInstructions(NamedTuple):
+    """
+    The options given by an instruction string, as described in the docstring
+    of ExcelModifier.colourize_columns.
+    """
+    margin_upper: float
+    margin_lower: float
+    colour_upper: str
+    colour_lower: str
+    majority_percentage: float
+    formatting_option: str
+    row_offset: int
+    column_offset: int
+
+
+@functools.lru_cache(maxsize=128)
+def _parse_instructions(instructions: str) -> _ParsedInstructions:
+    """
+    Given an instruction string of the format described in the docstring of
+    ExcelModifier.colourize_columns, return the options it specifies. The
+    result is cached so that the same instruction string is only parsed once.
+    """
+    tokens = instructions.split()
+
+    params_to_pass = {}
+
+    # going through each (instruction, value) pair in the split instructions
+    for key, value in zip(tokens[0::2], tokens[1::2]):
+        option, convert = _INSTRUCTION_DISPATCH[key]
+        params_to_pass[option] = convert(value)
+
+    return _ParsedInstructions(**params_to_pass)
+
+
+def _column_stats(block: np.ndarray) -> tuple[np.ndarray, np.ndarray,
+                                               np.ndarray, np.ndarray]:
+    """
+    Returns a tuple of the form (smallest, largest, S, L) of arrays with one
+    entry per column of block, where smallest and largest hold the smallest
+    and largest non-NaN values in each column, and S and L hold the number of
+    times each of them appears in that column.
+
+    Args:
+    - block: a 2D float array in which every column holds the data of a single
+      column of a sheet
+    """
+    # fmin/fmax skip NaNs, and the NaN initial value covers empty columns
+    smallest = np.fmin.reduce(block, axis=0, initial=np.nan)
+    largest = np.fmax.reduce(block, axis=0, initial=np.nan)
+
+    return (smallest, largest, np.count_nonzero(block == smallest, axis=0),
+            np.count_nonzero(block == largest, axis=0))
+
+
+def _column_digest(column_values: np.ndarray) -> bytes:
+    """
+    Returns a digest of the data in column_values, which changes whenever any
+    of its values (or its length) changes.
+
+    Args:
+    - column_values: a float64 array containing the data of a single column
+    """
+    return hashlib.blake2b(np.ascontiguousarray(column_values),
+                           digest_size=16).digest()
+
+
+def _classify(block: np.ndarray, bounds: tuple[np.ndarray, np.ndarray],
+              extremes: tuple[np.ndarray, np.ndarray],
+              majorities: tuple[np.ndarray, np.ndarray],
+              sections: tuple[bool, bool]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns a tuple of the form (U, L) where U and L are boolean arrays with
+    the same shape as block that are True for the cells that fall within the
+    upper and lower margins, respectively. Every column of block is handled
+    at once.
+
+    Args:
+    - block: a 2D float array in which every column holds the data of a single
+      column of a sheet
+    - bounds: a tuple of the form (X, Y) where X and Y are arrays holding the
+      values returned by ExcelModifier._calculate_bounds for each column
+    - extremes: a tuple of the form (largest, smallest) of arrays holding the
+      largest and smallest values in each column
+    - majorities: a tuple of the form (A, B) of boolean arrays where A is
+      whether the largest value of each column is a majority and B is whether
+      the smallest value is a majority. A majority value is excluded from its
+      margin.
+    - sections: a tuple of booleans of the form (A, B) where A is whether the
+      upper margin should be coloured and B is whether the lower margin should
+      be coloured. An all-False array is returned for a margin that is not
+      coloured.
+    """
+    upper_bound_values, lower_bound_values = bounds
+    largest, smallest = extremes
+    upper_bound_majority_exists, lower_bound_majority_exists = majorities
+    colour_upper, colour_lower = sections
+
+    # empty cells are never coloured
+    valid = ~np.isnan(block)
+
+    if colour_upper:
+        upper_mask = valid & (block >= upper_bound_values) & (block <= largest)
+        # we don't want to include the largest element where it is a majority
+        upper_mask &= ~(upper_bound_majority_exists & (block == largest))
+    else:
+        upper_mask = np.zeros(block.shape, dtype=bool)
+
+    if colour_lower:
+        lower_mask = valid & (block <= lower_bound_values) & (block >= smallest)
+        # we don't want to include the smallest element where it is a majority
+        lower_mask &= ~(lower_bound_majority_exists & (block == smallest))
+    else:
+        lower_mask = np.zeros(block.shape, dtype=bool)
+
+    return (upper_mask, lower_mask)
+
+
+def _margin_formula(cell: str, low_cell: str, high_cell: str) -> str:
+    """
+    Returns an Excel formula that is TRUE when cell holds a number from the
+    value in low_cell to the value in high_cell (inclusive). This is used as
+    the criteria of a conditional format, so cell should be the first cell of
+    the range the format applies to. The bounds are given as cells rather than
+    as numbers so that Excel compares against the exact values in the sheet.
+
+    Args:
+    - cell: the cell reference the formula is relative to (e.g. 'B2')
+    - low_cell: an absolute reference to the cell holding the smallest value
+      in the margin (e.g. '$B$5')
+    - high_cell: an absolute reference to the cell holding the largest value
+      in the margin (e.g. '$B$9')
+    """
+    return f'=AND(ISNUMBER({cell}),{cell}>={low_cell},{cell}<={high_cell})'
 
 
 class ExcelModifier:
@@ -17,6 +190,8 @@ class ExcelModifier:
     def __init__(self, writer):
         self.workbook_writer = writer
         self.sheets_to_modify = {}
+        self._format_cache = {}
+        self._bounds_cache = {}
 
     def close(self):
         """
@@ -24,121 +199,126 @@ class ExcelModifier:
         """
         self.workbook_writer.close()
 
-    def set_sheets_to_modify(self, sheet_names: list[str]):
+    def _get_format(self, colour: str):
         """
-        Setter for self.sheets_to_modify. Sets the sheet names that the any
+        Returns the workbook format that colours a cell's background with
+        colour, registering it with the workbook the first time it is needed.
+
+        Args:
+        - colour: one of {'red', 'green'}, or a hex colour code of the form
+          '#RRGGBB' (e.g. '#FFEB9C')
+        """
+        colour_format = self._format_cache.get(colour)
+
+        if colour_format is None:
+            bg_colour = _PALETTE.get(colour, colour)
+            if not re.fullmatch(r'#[0-9A-Fa-f]{6}', bg_colour):
+                raise ValueError(f"'{colour}' is not 'red', 'green' or a hex "
+                                 "colour code of the form '#RRGGBB'")
+
+            colour_format = self.workbook_writer.book.add_format(
+                {'bg_color': bg_colour})
+            self._format_cache[colour] = colour_format
+
+        return colour_format
+
+    def set_sheets_to_modify(self, sheets: dict[str, pd.DataFrame]):
+        """
+        Setter for self.sheets_to_modify. Sets the sheets that the any
         modifying function in this class will use.
 
         Args:
-        - sheet_names: A list of strings that contain the names of the sheets
-          to modify.
+        - sheets: a dictionary which has key-value pairs of format {<sheet
+          name>: <sheet data>}, where sheet_name is the name of a sheet to
+          modify and sheet_data is the pandas DataFrame that contains the data
+          in that sheet.
         """
-        self.sheets_to_modify = sheet_names
+        self.sheets_to_modify = dict(sheets)
+        self._bounds_cache = {}
 
-    def _get_indices_to_edit(self, sheet_data: pd.DataFrame, columns: list[str] | list[tuple],
-                             multi_index: bool) -> list[int]:
+    def _get_indices_to_edit(self, sheet_data: pd.DataFrame,
+                             columns: list[str] | list[tuple]) -> list[int]:
         """
-        Given a dataframe sheet_data, the columns within the dataframe that should
-        be colourized, and whether or not the dataframe is multi-indexed, return
-        the indices of the columns that should be coloured.
+        Given a dataframe sheet_data and the columns within the dataframe that
+        should be colourized, return the indices of the columns that should be
+        coloured. This works the same for single- and multi-indexed dataframes.
 
         Args:
         - sheet_data: the DataFrame in which to find the columns
-        - columns: a list of columns to colourize. If multi_index is False,
-        then this is a list of strings. If multi_index is True, then this is
-        a list of tuples, each one representing a multi-indexed column name
-        (e.g. ('A', 'a')).
-        - multi_index: a boolean flag specifying if the dataframe is multi-indexed
-        or not
+        - columns: a list of columns to colourize. If the dataframe is
+        single-indexed, then this is a list of strings. If it is multi-indexed,
+        then this is a list of tuples, each one representing a multi-indexed
+        column name (e.g. ('A', 'a')).
         """
-        list_of_columns = sheet_data.columns.tolist()
-        return [i for i in range(len(list_of_columns)) if list_of_columns[i] in
-                columns and is_numeric_dtype(sheet_data[list_of_columns[i]])]
+        # looking up the positions of the requested columns (hashed lookup,
+        # works for tuples too), dropping any that are not in the dataframe
+        indices = sheet_data.columns.get_indexer_for(columns)
+        indices = np.unique(indices[indices >= 0])
+
+        # keeping only the columns that hold numeric data
+        numeric = np.array([is_numeric_dtype(sheet_data.dtypes.iloc[i])
+                           for i in indices], dtype=bool)
 
-    def _calculate_bounds(self, series: pd.Series, upper_bound: float,
-                          lower_bound: float) -> tuple[float, float]:
+        return indices[numeric].tolist()
+
+    def _calculate_bounds(self, block: np.ndarray, upper_bound: float,
+                          lower_bound: float) -> list[tuple[float, float]]:
         """
-        Returns a tuple of the form (X, Y) where  X is the value at the upper_bound
-        percentile and Y is the value of the lower_bound percentile of the data.
+        Returns a list with one tuple of the form (X, Y) per column in block,
+        where X is the value at the upper_bound percentile and Y is the value
+        of the lower_bound percentile of the data in that column.
         In other words, X is the number such that all numbers in the column > X are
         in the top upper_bound percentage of data, and Y is the number such that
         all numbers in the column < Y are in the bottom lower_bound percentage of
-        data. In other words,
+        data. Empty cells are ignored.
 
         Args:
-        - series: the pandas Series for which to calculate X and Y
+        - block: a 2D float array in which every column holds the data of a
+          single column of a sheet
         - upper_bound: the desired upper bound. For example, if this is 5.0, X
           will be the smallest number in the column such that the next largest
           number after X is part of the top 5% of data in the column.
         - lower_bound: the desired lower bound. For example, if this is 5.0, Y
           will be the largest number in the column such that the next largest
           number after Y is part of the bottom 5% of data in the column.
-        - lower_bound: the desired lower bound. For example, if this is 5.0, Y
-          will be the largest number in the column such that the next largest
-          number after Y is part of the bottom 5% of data in the column.
         """
-        sorted_series = series.sort_values()
-
-        # adjusting user inputs for the series.quantile function
+        # adjusting user inputs for the np.quantile function
         upper_bound_quantile = 1.0 - (upper_bound / 100.0)
         lower_bound_quantile = lower_bound / 100.0
 
-        # calculating X and Y using the series.quantile function
-        x = sorted_series.quantile(upper_bound_quantile)
-        y = sorted_series.quantile(lower_bound_quantile)
-
-        return (x, y)
-
-    def _parse_instructions(self, instructions: str) -> dict[str, str]:
-        """
-        Given an instruction string of the format described in the docstring of
-        self.colourize_columns, returned a dictionary of options to pass into
-        self._colourize_columns.
-        """
-        instruction_split = instructions.split()
-        POSSIBLE_INSTRUCTIONS = 'MmCcpsoO'
-
-        params_to_pass = {}
-
-        # going through each element in the split instructions
-        for i in range(len(instruction_split)):
-            current_elem = instruction_split[i]
-
-            # if this is indeed a new instruction
-            if current_elem in POSSIBLE_INSTRUCTIONS:
-                next_item = instruction_split[i + 1]
-                match current_elem:
-                    case 'M':
-                        params_to_pass['margin_upper'] = float(next_item)
-                    case 'm':
-                        params_to_pass['margin_lower'] = float(next_item)
-                    case 'C':
-                        params_to_pass['colour_upper'] = 'red' if next_item == 'r' else 'green'
-                    case 'c':
-                        params_to_pass['colour_lower'] = 'red' if next_item == 'r' else 'green'
-                    case 'p':
-                        params_to_pass['majority_percentage'] = float(
-                            next_item)
-                    case 's':
-                        match next_item:
-                            case 'u':
-                                params_to_pass['formatting_option'] = 'colour_upper'
-                            case 'l':
-                                params_to_pass['formatting_option'] = 'colour_lower'
-                            case 'b':
-                                params_to_pass['formatting_option'] = 'colour_both'
-                    case 'o':
-                        params_to_pass['row_offset'] = int(next_item)
-                    case 'O':
-                        params_to_pass['column_offset'] = int(next_item)
-
-        return params_to_pass
+        # row 0 holds X and row 1 holds Y for each column; columns with no data
+        # are left as NaN
+        quantiles = np.full((2, block.shape[1]), np.nan)
+
+        # np.quantile selects with np.partition rather than sorting, and
+        # handles every column without empty cells in a single call
+        has_nan = np.isnan(block).any(axis=0)
+        if block.shape[0] > 0 and not has_nan.all():
+            quantiles[:, ~has_nan] = np.quantile(
+                block[:, ~has_nan], [upper_bound_quantile, lower_bound_quantile], axis=0)
+
+        # columns with empty cells are handled one at a time on their non-empty
+        # values
+        for k in np.flatnonzero(has_nan):
+            column_values = block[:, k]
+            column_values = column_values[~np.isnan(column_values)]
+            if column_values.size > 0:
+                quantiles[:, k] = np.quantile(
+                    column_values, [upper_bound_quantile, lower_bound_quantile])
+
+        return [(quantiles[0, k], quantiles[1, k])
+                for k in range(block.shape[1])]
 
     def colourize_all(self, instructions: str, exclude_columns: list[str] = [], multi_index: bool = False) -> None:
         """
         Applies the instructions string to every column in every sheet in
         self.set_sheets_to_modify.
 
+        The colours are added to each sheet as conditional formats (one per
+        coloured margin of a column), not by rewriting cells. If a cell is
+        coloured by more than one call to colourize_all or colourize_columns,
+        the colour from the FIRST of those calls is the one that shows.
+
         Args:
         - instructions: the instructions string to apply to each column in every sheet
         - exclude_columns: a list of columns to EXCLUDE from colourization in
@@ -152,21 +332,23 @@ class ExcelModifier:
           single-indexed or multi-indexed.
         """
         # parse the instruction string
-        parsed_instructions = self._parse_instructions(instructions)
+        parsed_instructions = _parse_instructions(instructions)
 
         # extract the parameters from the parsed instructions
-        formatting_option = parsed_instructions['formatting_option']
+        formatting_option = parsed_instructions.formatting_option
         margin_options = (
-            parsed_instructions['margin_upper'], parsed_instructions['margin_lower'])
+            parsed_instructions.margin_upper, parsed_instructions.margin_lower)
         colour_options = (
-            parsed_instructions['colour_upper'], parsed_instructions['colour_lower'])
-        majority_percentage = parsed_instructions['majority_percentage']
+            parsed_instructions.colour_upper, parsed_instructions.colour_lower)
+        majority_percentage = parsed_instructions.majority_percentage
         write_offsets = (
-            parsed_instructions['row_offset'], parsed_instructions['column_offset'])
+            parsed_instructions.row_offset, parsed_instructions.column_offset)
 
         for sheet_name, sheet_data in self.sheets_to_modify.items():
-            columns = [column_name for column_name in sheet_data.columns.tolist(
-            ) if column_name not in exclude_columns]
+            # every column except the excluded ones, found positionally
+            # without building a list of names
+            columns = sheet_data.columns[~sheet_data.columns.isin(
+                exclude_columns)]
             # call the helper function
             self._colourize_columns(sheet_name, sheet_data, columns,
                                     formatting_option, margin_options,
@@ -178,6 +360,11 @@ class ExcelModifier:
         Given a string of instructions (specification below), colorize columns
         of all sheets in self.sheets_to_modify based on the instructions.
 
+        The colours are added to each sheet as conditional formats (one per
+        coloured margin of a column), not by rewriting cells. If a cell is
+        coloured by more than one call to colourize_columns or colourize_all,
+        the colour from the FIRST of those calls is the one that shows.
+
         Args:
         - columns: Signifies the columns to which the instructions passed to this
           function should be applied (for every sheet in self.sheets_to_modify).
@@ -202,10 +389,12 @@ class ExcelModifier:
         a space and an float from 0.0 to 100.0 (e.g. m 35.0).
         - C is used to specify the upper margin colour, which is the colour that
         any data within the upper margin will have. It is followed by a space
-        and one of {'r', 'g'} (e.g. C g).
+        and one of {'r', 'g'} or a hex colour code of the form #RRGGBB (e.g. C g
+        or C #FFEB9C).
         - c is used to specify the lower margin colour, which is the colour that
         any data within the lower margin will have. It is followed by a space
-        and one of {'r', 'g'} (e.g. c r).
+        and one of {'r', 'g'} or a hex colour code of the form #RRGGBB (e.g. c r
+        or c #FFEB9C).
         - p is used to specify the majority percentage, which is the percentage
         either the smallest or largest element in a column will have to take
         up to be a "majority", which will exclude it from being colorized. It
@@ -247,17 +436,17 @@ class ExcelModifier:
         self._colourize_columns.
         """
         # parse the instruction string
-        parsed_instructions = self._parse_instructions(instructions)
+        parsed_instructions = _parse_instructions(instructions)
 
         # extract the parameters from the parsed instructions
-        formatting_option = parsed_instructions['formatting_option']
+        formatting_option = parsed_instructions.formatting_option
         margin_options = (
-            parsed_instructions['margin_upper'], parsed_instructions['margin_lower'])
+            parsed_instructions.margin_upper, parsed_instructions.margin_lower)
         colour_options = (
-            parsed_instructions['colour_upper'], parsed_instructions['colour_lower'])
-        majority_percentage = parsed_instructions['majority_percentage']
+            parsed_instructions.colour_upper, parsed_instructions.colour_lower)
+        majority_percentage = parsed_instructions.majority_percentage
         write_offsets = (
-            parsed_instructions['row_offset'], parsed_instructions['column_offset'])
+            parsed_instructions.row_offset, parsed_instructions.column_offset)
 
         for sheet_name, sheet_data in self.sheets_to_modify.items():
             # call the helper function
@@ -274,7 +463,10 @@ class ExcelModifier:
                            write_offsets: tuple[int, int] = (0, 0), multi_index: bool = False) -> None:
         """
         Applies all options to the columns in columns_to_format in the sheet
-        with the name sheet_name.
+        with the name sheet_name. Each coloured margin is added to the sheet as
+        a conditional format over the column rather than by rewriting its
+        cells. Where the rules of several calls overlap on the same cell, the
+        rule added first takes precedence.
 
         Args:
         - sheet_name: the name of the sheet where changes should be applied
@@ -290,7 +482,7 @@ class ExcelModifier:
           0.0 to 100.0 (inclusive). X is the percent of the data to consider as the UPPER margin.
           Y is the percent of the data to consider as the LOWER margin.
         - colour_options: a tuple of the form (A, B) where A and B are strings
-          from the set {'red', 'green'}. A is the colour to apply to the UPPER margin of
+          from the set {'red', 'green'} or hex colour codes. A is the colour to apply to the UPPER margin of
           the data in a given column. B is the colour to apply to the LOWER margin of the data
           in a given column.
         - majority_percentage: a float from 0.0 to 100.0 which signifies the
@@ -341,81 +533,109 @@ class ExcelModifier:
         upper_colour, lower_colour = colour_options
 
         # creating reusable formats
-        # TODO: custom colours
-        upper_colour_format = self.workbook_writer.book.add_format(
-            {'bg_color': ('#FFC7CE' if upper_colour == 'red' else '#C6EFCE')})
-        lower_colour_format = self.workbook_writer.book.add_format(
-            {'bg_color': ('#FFC7CE' if lower_colour == 'red' else '#C6EFCE')})
+        upper_colour_format = self._get_format(upper_colour)
+        lower_colour_format = self._get_format(lower_colour)
 
         row_offset, column_offset = write_offsets
 
         column_indices_to_format = self._get_indices_to_edit(
-            sheet_data, columns_to_format, multi_index)
-        sheet_data_columns = sheet_data.columns.tolist()
-
-        # using the helper function to calculate bounds for each column
-        bounds = {column_index: self._calculate_bounds(
-            sheet_data[sheet_data_columns[column_index]], upper_bound,
-            lower_bound) for column_index in column_indices_to_format}
+            sheet_data, columns_to_format)
+
+        # converting the columns to format into one float64 block, so each
+        # column is a plain array view (column k of the block is the column at
+        # position column_indices_to_format[k] in sheet_data)
+        block = sheet_data.iloc[:, column_indices_to_format].to_numpy(
+            dtype=np.float64, na_value=np.nan)
+
+        # using the helper function to calculate bounds, in one go, for the
+        # columns whose bounds have not been calculated for these margins yet.
+        # Bounds are keyed on a digest of the column's data, so a column whose
+        # data changed (or moved) never reuses bounds calculated for other data
+        bounds_keys = [(_column_digest(block[:, k]), upper_bound, lower_bound)
+                       for k in range(block.shape[1])]
+        missing = [k for k, key in enumerate(bounds_keys)
+                   if key not in self._bounds_cache]
+        if missing:
+            self._bounds_cache.update(zip(
+                [bounds_keys[k] for k in missing],
+                self._calculate_bounds(block[:, missing], upper_bound,
+                                       lower_bound)))
+
+        # row k holds the (X, Y) bounds of column k of the block
+        bounds = np.array([self._bounds_cache[key] for key in bounds_keys],
+                          dtype=np.float64).reshape(-1, 2)
 
         # applying conditional formatting based on the bounds and column
         # formatting
         worksheet = self.workbook_writer.sheets[sheet_name]
-        num_rows = sheet_data.shape[0]
-
-        for column_pos in column_indices_to_format:
-            # which column are we in
-            # column_pos = sheet_data.columns.get_loc(column_index)
-            current_column = sheet_data[sheet_data_columns[
-                column_pos]]
-
-            # if the biggest and lowest data points take up this much percentage
-            # of the upper and lower bounds, respectively, they will not be
-            # colorized
-            ignore_bound_percentage = majority_percentage / 100
-
-            # find the largest item in the column
-            largest = current_column.max()
-            # this will contain whether or not the largest element appeas
-            # in more than majority_percentage% of this column
-            upper_bound_majority_exists = (
-                current_column == largest).mean() >= ignore_bound_percentage
-            # find the smallest item in the column
-            smallest = current_column.min()
-            # this will contain whether or not the smallest element appears
-            # in more than majority_percentage% of this column
-            lower_bound_majority_exists = (
-                current_column == smallest).mean() >= ignore_bound_percentage
-
-            # for each row in the column
-            for row_pos in range(0, num_rows):
-                current_data = sheet_data.iat[row_pos, column_pos]
-
-                if current_data != 'nan':
-                    # if the upper bound must be coloured
-                    if formatting_option in {'colour_upper', 'colour_both'}:
-                        if upper_bound_majority_exists:  # if this is true, we don't want to include the largest element
-                            if largest > current_data >= bounds[column_pos][0]:
-                                # overwriting the cell with the original data and new formatting
-                                worksheet.write(row_offset + row_pos, column_offset + column_pos,
-                                                current_data, upper_colour_format)
-                        else:
-                            if largest >= current_data >= bounds[column_pos][0]:
-                                # overwriting the cell with the original data and new formatting
-                                worksheet.write(row_offset + row_pos, column_offset + column_pos,
-                                                current_data, upper_colour_format)
-
-                    if formatting_option in {'colour_lower', 'colour_both'}:
-                        if lower_bound_majority_exists:  # if this is true, we don't want to include the smallest element
-                            if smallest < current_data <= bounds[column_pos][1]:
-                                # overwriting the cell with the original data and new formatting
-                                worksheet.write(row_offset + row_pos, column_offset + column_pos,
-                                                current_data, lower_colour_format)
-                        else:
-                            if smallest <= current_data <= bounds[column_pos][1]:
-                                # overwriting the cell with the original data and new formatting
-                                worksheet.write(row_offset + row_pos, column_offset + column_pos,
-                                                current_data, lower_colour_format)
+
+        # which margins must be coloured
+        colour_upper = formatting_option in {'colour_upper', 'colour_both'}
+        colour_lower = formatting_option in {'colour_lower', 'colour_both'}
+
+        # if the biggest and lowest data points take up this much percentage
+        # of the upper and lower bounds, respectively, they will not be
+        # colorized
+        ignore_bound_percentage = majority_percentage / 100
+
+        num_rows = block.shape[0]
+
+        # find the smallest and largest items in every column, and how many
+        # times each of them appears, in one go
+        smallest, largest, smallest_count, largest_count = _column_stats(block)
+        # this will contain whether or not the largest element appears
+        # in more than majority_percentage% of each column
+        upper_bound_majority_exists = colour_upper & (
+            largest_count / max(num_rows, 1) >= ignore_bound_percentage)
+        # this will contain whether or not the smallest element appears
+        # in more than majority_percentage% of each column
+        lower_bound_majority_exists = colour_lower & (
+            smallest_count / max(num_rows, 1) >= ignore_bound_percentage)
+
+        # finding the cells that fall within each margin for every column
+        upper_mask, lower_mask = _classify(
+            block, (bounds[:, 0], bounds[:, 1]), (largest, smallest),
+            (upper_bound_majority_exists, lower_bound_majority_exists),
+            (colour_upper, colour_lower))
+
+        # the sheet coordinates every rule is written at, worked out once: the
+        # rows covered by each rule and the column each block column maps to
+        first_row, last_row = row_offset, row_offset + num_rows - 1
+        write_columns = [column_offset + column_pos
+                         for column_pos in column_indices_to_format]
+
+        # xlsxwriter is not thread-safe, so the rules are added one column at
+        # a time
+        for k, column in enumerate(write_columns):
+            first_cell = xl_rowcol_to_cell(first_row, column)
+
+            # the lower margin rule is added first so that, as before, it wins
+            # over the upper margin rule for cells that fall in both
+            for margin_mask, colour_format in ((lower_mask[:, k], lower_colour_format),
+                                               (upper_mask[:, k], upper_colour_format)):
+                margin_rows = np.flatnonzero(margin_mask)
+
+                # nothing to colour in this margin
+                if margin_rows.size == 0:
+                    continue
+
+                # the cells in a margin are exactly the ones whose values lie
+                # between its smallest and largest cells (a majority value has
+                # already been left out of the mask)
+                margin_values = block[margin_rows, k]
+                low_cell, high_cell = (
+                    xl_rowcol_to_cell(first_row + row_pos, column,
+                                      row_abs=True, col_abs=True)
+                    for row_pos in (margin_rows[margin_values.argmin()],
+                                    margin_rows[margin_values.argmax()]))
+
+                # the rule covers the whole column, with its formula written
+                # relative to the first cell
+                worksheet.conditional_format(
+                    first_row, column, last_row, column,
+                    {'type': 'formula',
+                     'criteria': _margin_formula(first_cell, low_cell, high_cell),
+                     'format': colour_format})
 
     def autofit_sheets(self) -> None:
         """
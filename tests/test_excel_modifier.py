@@ -0,0 +1,78 @@
+import io
+
+import numpy as np
+import pandas as pd
+
+from excel_modifier import ExcelModifier
+
+INSTRUCTIONS = 'M 20 m 20 C g c r p 10 s b o 1 O 1'
+
+
+def _make_modifier(sheets: dict[str, pd.DataFrame]) -> tuple[ExcelModifier, list]:
+    """
+    Returns an ExcelModifier for an in-memory workbook holding sheets, and a
+    list that records the arguments of every conditional_format call made on
+    those sheets.
+    """
+    writer = pd.ExcelWriter(io.BytesIO(), engine='xlsxwriter')
+    for sheet_name, sheet_data in sheets.items():
+        sheet_data.to_excel(writer, sheet_name=sheet_name)
+
+    calls = []
+    for sheet_name in sheets:
+        worksheet = writer.sheets[sheet_name]
+
+        def record(*args, worksheet=worksheet, sheet_name=sheet_name):
+            calls.append((sheet_name, *args))
+            return type(worksheet).conditional_format(worksheet, *args)
+
+        worksheet.conditional_format = record
+
+    modifier = ExcelModifier(writer)
+    modifier.set_sheets_to_modify(sheets)
+    return modifier, calls
+
+
+def _rules(calls: list) -> list:
+    """
+    Returns the sheet, range and criteria of every recorded conditional_format
+    call in calls.
+    """
+    return [(sheet_name, first_row, first_column, last_row, last_column,
+             options['criteria'])
+            for sheet_name, first_row, first_column, last_row, last_column, options
+            in calls]
+
+
+def test_bounds_follow_changes_to_the_sheet_data():
+    df = pd.DataFrame({'v': np.arange(10.0), 'w': np.arange(10.0)[::-1]})
+    modifier, calls = _make_modifier({'S': df})
+    modifier.colourize_columns(['v', 'w'], INSTRUCTIONS)
+
+    # changing the data in place, and shifting every column by one position
+    df['v'] = np.arange(10.0) * 3 % 7
+    df.insert(0, 'id', np.arange(10))
+    calls.clear()
+    modifier.colourize_columns(['v', 'w'], INSTRUCTIONS)
+
+    # a modifier that has never seen the old data must add the same rules
+    fresh_modifier, fresh_calls = _make_modifier({'S': df})
+    fresh_modifier.colourize_columns(['v', 'w'], INSTRUCTIONS)
+
+    assert _rules(calls) == _rules(fresh_calls)
+
+
+def test_margins_are_added_as_conditional_formats():
+    df = pd.DataFrame({'v': np.arange(10.0)})
+    modifier, calls = _make_modifier({'S': df})
+    modifier.colourize_columns(['v'], 'M 20 m 20 C g c r p 50 s b o 1 O 1')
+
+    # one rule per margin over column B (the index is in column A), each
+    # bounded by the cells holding the margin's smallest and largest values;
+    # the lower margin rule comes first so it wins where the margins overlap
+    assert _rules(calls) == [
+        ('S', 1, 1, 10, 1, '=AND(ISNUMBER(B2),B2>=$B$2,B2<=$B$3)'),
+        ('S', 1, 1, 10, 1, '=AND(ISNUMBER(B2),B2>=$B$10,B2<=$B$11)'),
+    ]
+    assert calls[0][5]['format'] is modifier._get_format('red')
+    assert calls[1][5]['format'] is modifier._get_format('green')